@@ -1,23 +1,42 @@
 import asyncio
 import argparse
+import collections
 import datetime
+import hashlib
 import os
-import shutil
+import platform
 import signal
-import tempfile
+import struct
+import subprocess
+import threading
 import time
-import wave
 from typing import Generator
 
 import numpy as np
 import pyaudio
 
-from faster_whisper import WhisperModel
+from faster_whisper import BatchedInferencePipeline, WhisperModel
 from faster_whisper.utils import available_models
 import llm
 from playwright.async_api import async_playwright
 
 
+def default_cpu_threads() -> int:
+    """Guess the number of physical (performance) cores"""
+    if platform.system() == "Darwin" and platform.machine() == "arm64":
+        # Efficiency cores only slow down CTranslate2's parallel sections
+        try:
+            out = subprocess.run(
+                ["sysctl", "-n", "hw.perflevel0.physicalcpu"],
+                capture_output=True, text=True, check=True,
+            ).stdout
+            return int(out)
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            pass
+    # Assume two hardware threads per core
+    return max(1, (os.cpu_count() or 2) // 2)
+
+
 class TranscriptionService:
     # Audio configuration
     FORMAT = pyaudio.paInt16
@@ -25,21 +44,54 @@ class TranscriptionService:
     RATE = 16000
     CHUNK = 1024 * 128  # Larger chunk for better transcription
     SILENCE_THRESHOLD_MEAN = 300
+    NOISE_THRESHOLD_RMS = 400  # Segments both this quiet...
+    NOISE_THRESHOLD_ZCR = 0.05  # ...and this low-pitched are skipped
     TRUNC_AUDIO_BUFFER = 60  # Avoid too much lagging
+    BATCH_SIZE = 8  # VAD chunks decoded together on GPU
+    TRANSLATION_CACHE_SIZE = 1024
+    HISTORY_SIZE = 1024  # Segment timestamps kept in memory
+    STATUS_INTERVAL = 1.0  # Seconds between buffer status lines
+    WEBPAGE_FLUSH_INTERVAL = 0.25  # Seconds between batched webpage updates
 
     def __init__(self, args):
         self.args = args
-        self.audio_buffer = []
-        self.transcript_buffer = []
+        # Ring buffer of non-silent samples, filled by the audio callback.
+        # Indices count samples written/read in total and are wrapped on use.
+        self.audio_buffer = np.empty(
+            self.CHUNK * self.TRUNC_AUDIO_BUFFER, dtype=np.int16
+        )
+        self._w_idx = 0
+        self._r_idx = 0
+        self._idx_lock = threading.Lock()
+        # Scratch space for the silence check, reused on every callback
+        self._abs_scratch = np.empty(self.CHUNK, dtype=np.int16)
+        self.segment_count = 0
+        self.last_status_time = 0.0
         self.running = True
+        # Producers wake consumers through these instead of polling.
+        # The service is created inside the running event loop.
+        self.loop = asyncio.get_running_loop()
+        self.audio_ready = asyncio.Event()
+        self.transcript_queue = asyncio.Queue()
         self.stream = None
         self.p_audio = None
         self.model = None
-        self.temp_dir = tempfile.gettempdir()
+        self.batched_model = None
+        # faster-whisper is not safe to call concurrently
+        self.model_lock = asyncio.Lock()
+        # Transcripts waiting to be written to the webpage
+        self.pending_texts = []
+        self.editor_elem = None
+        # LLM translations keyed by normalized source text
+        self.translation_cache = collections.OrderedDict()
+        # Names for audio files kept with --keep
+        self.session_name = datetime.datetime.now().isoformat(timespec="seconds")
+        self.segment_seq = 0
         # Add timestamp tracking for delay calculation
-        self.segment_timestamps = {}
+        self.segment_timestamps = collections.OrderedDict()
         # Load initial prompt if file exists
         self.initial_prompt = None
+        self.initial_prompt_ids = None
         try:
             with open("transcribe_prompt.txt", "r") as f:
                 self.initial_prompt = f.read().strip()
@@ -53,7 +105,7 @@ class TranscriptionService:
     def handle_exit(self, sig, frame):
         """Handle exit signals gracefully"""
         print("\nShutting down gracefully...")
-        self.running = False
+        self.stop()
 
         # Clean up resources
         if self.stream and self.stream.is_active():
@@ -65,6 +117,16 @@ class TranscriptionService:
 
         print("Resources cleaned up. Exiting.")
 
+    def stop(self) -> None:
+        """Stop all loops and wake any coroutine waiting for work"""
+        self.running = False
+        self.loop.call_soon_threadsafe(self._wake_waiters)
+
+    def _wake_waiters(self) -> None:
+        """Release coroutines blocked on audio or transcripts"""
+        self.audio_ready.set()
+        self.transcript_queue.put_nowait(None)
+
     def list_audio_devices(self):
         """List available audio input devices"""
         p = pyaudio.PyAudio()
@@ -88,41 +150,137 @@ class TranscriptionService:
         """Process incoming audio data"""
 
         audio_data = np.frombuffer(in_data, dtype=np.int16)
-        if np.abs(audio_data).mean() > self.SILENCE_THRESHOLD_MEAN:
-            self.audio_buffer.append(in_data)
-        return (in_data, pyaudio.paContinue)
+        n = len(audio_data)
+        if n > len(self._abs_scratch):
+            self._abs_scratch = np.empty(n, dtype=np.int16)
+
+        # abs(-32768) wraps to -32768 in int16, which reads back as 32768
+        # through a uint16 view, so the sum is exact without a temporary
+        loudness = np.abs(audio_data, out=self._abs_scratch[:n])
+        if loudness.view(np.uint16).sum(dtype=np.uint64) > self.SILENCE_THRESHOLD_MEAN * n:
+            capacity = len(self.audio_buffer)
+            start = self._w_idx % capacity
+            end = start + n
+            if end <= capacity:
+                np.copyto(self.audio_buffer[start:end], audio_data)
+            else:
+                split = capacity - start
+                np.copyto(self.audio_buffer[start:], audio_data[:split])
+                np.copyto(self.audio_buffer[:end - capacity], audio_data[split:])
+            with self._idx_lock:
+                self._w_idx += n
+            self.loop.call_soon_threadsafe(self.audio_ready.set)
+        # Input-only stream, so there is no output buffer to hand back
+        return (None, pyaudio.paContinue)
+
+    def pending_audio(self) -> int:
+        """Number of buffered samples not yet transcribed"""
+        with self._idx_lock:
+            return self._w_idx - self._r_idx
+
+    def read_audio(self) -> tuple[np.ndarray, bool]:
+        """Take all pending samples out of the ring buffer"""
+        with self._idx_lock:
+            w_idx = self._w_idx
+            r_idx = self._r_idx
+            self._r_idx = w_idx
+
+        # Oldest samples were overwritten if the consumer fell behind
+        capacity = len(self.audio_buffer)
+        is_trunc = w_idx - r_idx > capacity
+        if is_trunc:
+            r_idx = w_idx - capacity
+
+        start = r_idx % capacity
+        end = start + (w_idx - r_idx)
+        if end <= capacity:
+            pcm = self.audio_buffer[start:end].copy()
+        else:
+            pcm = np.concatenate(
+                (self.audio_buffer[start:], self.audio_buffer[:end - capacity])
+            )
+        return pcm, is_trunc
+
+    def wav_header(self, n_bytes: int) -> bytes:
+        """Build the 44-byte RIFF header for n_bytes of PCM data"""
+        block_align = self.CHANNELS * 2  # 2 bytes for paInt16
+        return struct.pack(
+            "<4sI4s4sIHHIIHH4sI",
+            b"RIFF", 36 + n_bytes, b"WAVE",
+            b"fmt ", 16, 1, self.CHANNELS, self.RATE,
+            self.RATE * block_align, block_align, 16,
+            b"data", n_bytes,
+        )
+
+    def save_wav(self, pcm: np.ndarray, path: str) -> None:
+        """Write int16 samples to a WAV file"""
+        with open(path, "wb") as f:
+            f.write(self.wav_header(pcm.nbytes))
+            f.write(pcm)
+
+    def is_noise(self, audio: np.ndarray) -> bool:
+        """Cheap energy and zero-crossing check for low-information audio"""
+        rms = np.sqrt(np.dot(audio, audio) / len(audio)) * 32768.0
+        zcr = np.count_nonzero(np.diff(np.signbit(audio))) / len(audio)
+        return rms < self.NOISE_THRESHOLD_RMS and zcr < self.NOISE_THRESHOLD_ZCR
+
+    def run_model(self, audio: np.ndarray, task: str, emit) -> None:
+        """Run Whisper on a segment, emitting text as it is decoded (blocking)"""
+        try:
+            options = {
+                "language": self.args.lang,
+                "task": task,
+                "beam_size": 5,
+            }
+            if self.batched_model:
+                # The batched pipeline only accepts the prompt as a string
+                segments, _ = self.batched_model.transcribe(
+                    audio,
+                    batch_size=self.BATCH_SIZE,
+                    initial_prompt=self.initial_prompt,
+                    **options,
+                )
+            else:
+                segments, _ = self.model.transcribe(
+                    audio, initial_prompt=self.initial_prompt_ids, **options
+                )
+
+            # Segments are decoded lazily, so iterate them here too.
+            # Crude VAD: drop segments Whisper itself thinks are silence.
+            for text in (s.text for s in segments if s.no_speech_prob < 0.5):
+                emit(text)
+        finally:
+            # Tell the consumer this segment is done
+            emit(None)
 
     async def transcribe_audio(self) -> Generator[str, None, None]:
         """Process audio buffer and transcribe content"""
         while self.running:
-            if len(self.audio_buffer) > 0:
+            await self.audio_ready.wait()
+            self.audio_ready.clear()
+            if self.pending_audio() > 0:
                 # Record start time for delay calculation
                 start_time = time.time()
 
-                # Copy and clear the buffer
-                if len(self.audio_buffer) > self.TRUNC_AUDIO_BUFFER:
-                    current_buffer = (
-                        self.audio_buffer[:self.TRUNC_AUDIO_BUFFER]
-                        .copy()
-                    )
-                    is_trunc = True
-                else:
-                    current_buffer = self.audio_buffer.copy()
-                    is_trunc = False
+                # Take the pending audio out of the ring buffer
+                pcm, is_trunc = self.read_audio()
 
-                self.audio_buffer = []
+                # Whisper expects float32 samples in [-1, 1)
+                audio = pcm.astype(np.float32)
+                audio *= 1.0 / 32768.0
 
-                # Save buffer to temp WAV file
-                timestamp = time.time()
-                temp_file = os.path.join(
-                    self.temp_dir,
-                    f"segment_{timestamp}.wav",
-                )
-                with wave.open(temp_file, "wb") as wf:
-                    wf.setnchannels(self.CHANNELS)
-                    wf.setsampwidth(2)  # 2 bytes for paInt16
-                    wf.setframerate(self.RATE)
-                    wf.writeframes(b"".join(current_buffer))
+                # Don't spend a model call on hum or breath noise
+                if self.is_noise(audio):
+                    continue
+
+                # Write the audio in the background while it is transcribed
+                saving = None
+                if self.args.keep:
+                    self.segment_seq += 1
+                    fn = f"{self.session_name}_{self.segment_seq:06d}.wav"
+                    saving = asyncio.create_task(
+                        asyncio.to_thread(self.save_wav, pcm, fn)
+                    )
 
                 # Determine task based on mode
                 task = (
@@ -131,150 +289,198 @@ class TranscriptionService:
                     else "transcribe"
                 )
 
-                # Transcribe audio
-                segments, _ = self.model.transcribe(
-                    temp_file,
-                    language=self.args.lang,
-                    task=task,
-                    beam_size=5,
-                    initial_prompt=self.initial_prompt,
-                )
-
-                # Get transcription text
-                result = []
-                for segment in segments:
-                    # Crude VAD
-                    if segment.no_speech_prob < 0.5:
-                        result.append(segment.text)
-
-                text = " ".join(result)
-                if is_trunc:
-                    text += ' (truncated)'
-
-                # Calculate and display delay
-                end_time = time.time()
-                delay = end_time - start_time
-                segment_id = len(self.transcript_buffer)
-                self.segment_timestamps[segment_id] = {
-                    "start": start_time,
-                    "end": end_time,
-                    "delay": delay
-                }
+                # Transcribe in a worker thread and hand each decoded
+                # segment back as soon as it is ready
+                segments = asyncio.Queue()
 
-                text_with_delay = f"{text} [Delay: {delay:.2f}s]"
+                def emit(text):
+                    self.loop.call_soon_threadsafe(segments.put_nowait, text)
 
-                # Clean up
                 try:
-                    if self.args.keep:
-                        fn = f"{datetime.datetime.now().isoformat()}.wav"
-                        shutil.move(temp_file, fn)
-                    else:
-                        os.remove(temp_file)
-                except Exception:
-                    print("Failed to move or remove tmp file")
-
-                if text.strip():
-                    # Add to transcript buffer and yield
-                    self.transcript_buffer.append(text)
-                    if self.args.show_delay:
-                        yield text_with_delay
-                    else:
-                        yield text
+                    async with self.model_lock:
+                        worker = asyncio.create_task(
+                            asyncio.to_thread(self.run_model, audio, task, emit)
+                        )
+                        while (text := await segments.get()) is not None:
+                            if is_trunc:
+                                # Oldest audio was dropped, mark the first text
+                                text += ' (truncated)'
+                                is_trunc = False
+
+                            # Calculate and display delay
+                            end_time = time.time()
+                            delay = end_time - start_time
+                            segment_id = self.segment_count
+                            self.segment_timestamps[segment_id] = {
+                                "start": start_time,
+                                "end": end_time,
+                                "delay": delay
+                            }
+                            if len(self.segment_timestamps) > self.HISTORY_SIZE:
+                                self.segment_timestamps.popitem(last=False)
+
+                            text_with_delay = f"{text} [Delay: {delay:.2f}s]"
+
+                            if text.strip():
+                                # Hand off to the translator and yield
+                                self.segment_count += 1
+                                if self.args.mode != "transcribe":
+                                    self.transcript_queue.put_nowait(
+                                        (segment_id, text)
+                                    )
+                                if self.args.show_delay:
+                                    yield text_with_delay
+                                else:
+                                    yield text
+                        await worker
+                finally:
+                    # Never leave the WAV write behind, even if Whisper failed
+                    if saving:
+                        try:
+                            await saving
+                        except Exception:
+                            print("Failed to save audio file")
 
             # Status update
-            print(
-                f"Buffers: audio={len(self.audio_buffer)}, transcript={len(self.transcript_buffer)}",
-                end="\r",
-            )
-            await asyncio.sleep(0.1)
+            now = time.monotonic()
+            if now - self.last_status_time >= self.STATUS_INTERVAL:
+                self.last_status_time = now
+                print(
+                    f"Buffers: audio={self.pending_audio() // self.CHUNK}, transcript={self.segment_count}",
+                    end="\r",
+                )
+
+    @staticmethod
+    def translation_key(text: str) -> bytes:
+        """Cache key that ignores case and whitespace differences"""
+        normalized = " ".join(text.lower().split())
+        return hashlib.blake2b(normalized.encode()).digest()
 
     async def translate(self) -> None:
         """Translate transcribed text using specified method"""
-        last_index = 0
-
         if self.args.mode == "translate-llm":
             model = llm.get_async_model(self.args.model_translate)
             with open(self.args.translation_prompt, "r") as f:
                 prompt = f.read()
 
             while self.running:
-                if last_index < len(self.transcript_buffer):
-                    text = self.transcript_buffer[last_index]
-                    # Get delay info for this segment
-                    delay_info = ""
-                    if last_index in self.segment_timestamps:
-                        delay = self.segment_timestamps[last_index]["delay"]
-                        delay_info = f" [Delay: {delay:.2f}s]"
-
-                    prompt_text = f"{prompt}\n---\n{text}"
-                    translation_start = time.time()
-                    output = await model.prompt(prompt_text).text()
-                    translation_end = time.time()
-                    translation_delay = translation_end - translation_start
-
-                    if self.args.show_delay:
-                        print(f"\nTranslated: {output}{delay_info} [Translation delay: {translation_delay:.2f}s]")
-                    else:
-                        print(f"\nTranslated: {output}")
-
-                    last_index += 1
-                await asyncio.sleep(0.1)
+                item = await self.transcript_queue.get()
+                if item is None:
+                    break
+                segment_id, text = item
+
+                # Get delay info for this segment
+                delay_info = ""
+                if segment_id in self.segment_timestamps:
+                    delay = self.segment_timestamps[segment_id]["delay"]
+                    delay_info = f" [Delay: {delay:.2f}s]"
+
+                translation_start = time.time()
+                key = self.translation_key(text)
+                output = self.translation_cache.get(key)
+                if output is None:
+                    # Keep the instructions in a fixed system prompt so the
+                    # backend can reuse its cached prefix between segments
+                    output = await model.prompt(text, system=prompt).text()
+                    self.translation_cache[key] = output
+                    if len(self.translation_cache) > self.TRANSLATION_CACHE_SIZE:
+                        self.translation_cache.popitem(last=False)
+                else:
+                    self.translation_cache.move_to_end(key)
+                translation_end = time.time()
+                translation_delay = translation_end - translation_start
+
+                if self.args.show_delay:
+                    print(f"\nTranslated: {output}{delay_info} [Translation delay: {translation_delay:.2f}s]")
+                else:
+                    print(f"\nTranslated: {output}")
 
         elif self.args.mode == "translate-whisper":
             while self.running:
-                if last_index < len(self.transcript_buffer):
-                    text = self.transcript_buffer[last_index]
-                    # Get delay info for this segment
-                    delay_info = ""
-                    if last_index in self.segment_timestamps:
-                        delay = self.segment_timestamps[last_index]["delay"]
-                        delay_info = f" [Delay: {delay:.2f}s]"
-
-                    if self.args.show_delay:
-                        print(f"\nTranslated: {text}{delay_info}")
-                    else:
-                        print(f"\nTranslated: {text}")
-
-                    last_index += 1
-                await asyncio.sleep(0.1)
-
-    async def update_webpage(self, page, text: str) -> None:
-        """Update the webpage with transcribed text"""
-        elem = (
-            page.locator("#sbox-iframe")
-            .content_frame.locator('iframe[title="Editor\\, editor1"]')
-            .content_frame.locator("html")
-        )
-        # Properly escape the text for safe insertion into JavaScript
-        escaped_text = text.replace('"', '\\"').replace("\n", "\\n")
-        await elem.evaluate(
-            f"""
-            let body = document.querySelector("body");
-            let p = document.createElement("p");
-            p.textContent = "{escaped_text}";
-            body.appendChild(p);
+                item = await self.transcript_queue.get()
+                if item is None:
+                    break
+                segment_id, text = item
+
+                # Get delay info for this segment
+                delay_info = ""
+                if segment_id in self.segment_timestamps:
+                    delay = self.segment_timestamps[segment_id]["delay"]
+                    delay_info = f" [Delay: {delay:.2f}s]"
+
+                if self.args.show_delay:
+                    print(f"\nTranslated: {text}{delay_info}")
+                else:
+                    print(f"\nTranslated: {text}")
+
+    def update_webpage(self, text: str) -> None:
+        """Queue transcribed text for the next webpage update"""
+        self.pending_texts.append(text)
+
+    async def flush_webpage(self, page) -> None:
+        """Append all queued text to the webpage in a single call"""
+        if not self.pending_texts:
+            return
+        # Only drop the texts once they are on the page, so a flush that is
+        # cancelled halfway leaves them queued for the next one
+        texts = self.pending_texts.copy()
+
+        # Pass the text as an argument so Playwright takes care of escaping
+        await self.editor_elem.evaluate(
             """
+            (html, texts) => {
+                let body = document.querySelector("body");
+                for (const text of texts) {
+                    let p = document.createElement("p");
+                    p.textContent = text;
+                    body.appendChild(p);
+                }
+            }
+            """,
+            texts,
         )
+        del self.pending_texts[:len(texts)]
         # Trigger save
         await asyncio.sleep(0.1)
         await page.keyboard.press('Enter')
         await page.keyboard.press('Backspace')
 
+    async def webpage_updater(self, page) -> None:
+        """Periodically flush queued text to the webpage"""
+        try:
+            while self.running:
+                await asyncio.sleep(self.WEBPAGE_FLUSH_INTERVAL)
+                await self.flush_webpage(page)
+        except Exception as e:
+            print(f"\nError: {e}")
+            self.stop()
+
     async def start_transcription(self) -> None:
         """Initialize and start the transcription process"""
         # Initialize Whisper model
         print(f"Initializing Whisper model '{self.args.model}' on {self.args.whisper_device} with {self.args.compute_type} precision...")
         
         # Check if running on macOS
-        import platform
         if platform.system() == "Darwin" and platform.machine() == "arm64":
             print("Note: faster-whisper doesn't support M1 GPU acceleration. For GPU support, consider whisper.cpp instead.")
         
         self.model = WhisperModel(
             self.args.model, 
             device=self.args.whisper_device, 
-            compute_type=self.args.compute_type
+            compute_type=self.args.compute_type,
+            cpu_threads=self.args.cpu_threads,
+            num_workers=self.args.num_workers,
         )
+        # Tokenize the initial prompt once rather than for every segment,
+        # the same way faster-whisper does for a string prompt
+        if self.initial_prompt:
+            self.initial_prompt_ids = self.model.hf_tokenizer.encode(
+                " " + self.initial_prompt, add_special_tokens=False
+            ).ids
+        # Batching only pays off on GPU, keep sequential decoding on CPU.
+        # Check the resolved device since "auto" may fall back to CPU.
+        if self.model.model.device == "cuda":
+            self.batched_model = BatchedInferencePipeline(model=self.model)
 
         # Start audio recording
         self.p_audio = pyaudio.PyAudio()
@@ -297,7 +503,7 @@ class TranscriptionService:
                 if device_index is None:
                     print(f"Error: No audio device found matching '{self.args.device}'")
                     print("Use --list-devices to see available devices")
-                    self.running = False
+                    self.stop()
                     return
         
         # Open audio stream
@@ -318,7 +524,7 @@ class TranscriptionService:
         except Exception as e:
             print(f"Error opening audio device: {e}")
             print("Use --list-devices to see available devices")
-            self.running = False
+            self.stop()
             return
 
         self.stream.start_stream()
@@ -331,23 +537,35 @@ class TranscriptionService:
                 page = await browser.new_page()
 
                 await page.goto(self.args.url)
-                (
-                    await page.locator("#sbox-iframe")
+                # Build the locator through both iframes once and reuse it
+                self.editor_elem = (
+                    page.locator("#sbox-iframe")
                     .content_frame.locator('iframe[title="Editor\\, editor1"]')
                     .content_frame.locator("html")
-                    .click()
                 )
+                await self.editor_elem.click()
 
+                updater = asyncio.create_task(self.webpage_updater(page))
                 try:
                     async for text in self.transcribe_audio():
                         # Update webpage and print progress
-                        await self.update_webpage(page, text)
+                        self.update_webpage(text)
                         if self.args.mode == "transcribe":
                             print(f"\nTranscribed: {text}")
                 except Exception as e:
                     print(f"\nError: {e}")
-                    self.running = False
+                    self.stop()
                 finally:
+                    updater.cancel()
+                    try:
+                        await updater
+                    except asyncio.CancelledError:
+                        pass
+                    # Write out whatever was yielded after the last flush
+                    try:
+                        await self.flush_webpage(page)
+                    except Exception as e:
+                        print(f"\nError: {e}")
                     await browser.close()
         else:
             # Console-only mode
@@ -357,7 +575,7 @@ class TranscriptionService:
                         print(f"\nTranscribed: {text}")
             except Exception as e:
                 print(f"\nError: {e}")
-                self.running = False
+                self.stop()
 
 
 async def main():
@@ -420,6 +638,18 @@ async def main():
         default="int8",
         help="Compute type for Whisper model (default: int8). For best performance on M1, use int8",
     )
+    parser.add_argument(
+        "--cpu-threads",
+        type=int,
+        default=default_cpu_threads(),
+        help="Threads used by Whisper on CPU (default: number of physical cores)",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=1,
+        help="Whisper model replicas (default: 1). Values above 1 only help with concurrent transcribe calls, which this tool does not make",
+    )
 
     args = parser.parse_args()
 